@@ -4,46 +4,166 @@ __email__ = "manuel.holtgrewe@bihealth.de"
 __license__ = "MIT"
 
 import contextlib
-import datetime
 from itertools import chain
 import os
 import sys
 import time
 import threading
 
-import psutil
-import GPUtil
-
 from snakemake.exceptions import WorkflowError
 
 
-#: Interval (in seconds) between measuring resource usage
+#: Maximal interval (in seconds) between measuring resource usage
 BENCHMARK_INTERVAL = 30
-#: Interval (in seconds) between measuring resource usage before
-#: BENCHMARK_INTERVAL
+#: Initial interval (in seconds) between measuring resource usage
 BENCHMARK_INTERVAL_SHORT = 0.5
+#: Factor by which the interval grows after each measurement, until it
+#: reaches BENCHMARK_INTERVAL
+BENCHMARK_INTERVAL_GROWTH = 1.5
+#: Time (in seconds) for which a scan of the observed process' children is
+#: reused before walking the process tree again
+BENCHMARK_CHILDREN_TTL = 5.0
+
+#: psutil and pynvml are imported on first use by _lazy_psutil() and
+#: _lazy_pynvml(), so importing this module stays cheap for callers that do
+#: not benchmark, e.g. ``benchmarked(pid=False)``
+psutil = None
+pynvml = None
+
+
+def _lazy_psutil():
+    """Return the psutil module, importing it on first use"""
+    global psutil
+    if psutil is None:
+        import psutil
+    return psutil
+
+
+def _lazy_pynvml():
+    """Return the pynvml module, importing it on first use"""
+    global pynvml
+    if pynvml is None:
+        import pynvml
+    return pynvml
+
+
+#: Factor converting bytes to MB
+_MB = 1.0 / (1024 * 1024)
+
+#: Path of the Unix socket of a running benchmark_daemon.py; if set,
+#: ``benchmarked()`` has the daemon sample its process instead of starting
+#: a sampler thread of its own
+BENCHMARK_DAEMON_SOCKET = os.environ.get("RETICULATUS_BENCHMARK_SOCKET")
+
+#: Whether resource usage can be read from /proc directly, rather than
+#: through psutil
+PROC_FS = sys.platform.startswith("linux") and os.path.isdir("/proc")
+if PROC_FS:
+    _PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+    _CLK_TCK = os.sysconf("SC_CLK_TCK")
+
+
+def sample_gpu(handle):
+    """Return load (in %) and memory used (in MB) of the GPU with the given
+    NVML handle"""
+    return (
+        float(pynvml.nvmlDeviceGetUtilizationRates(handle).gpu),
+        pynvml.nvmlDeviceGetMemoryInfo(handle).used * _MB,
+    )
+
+
+def _fast_read_stat(pid):
+    """Return CPU time and start time (in clock ticks), VMS and RSS (in
+    bytes) of pid from /proc/[pid]/stat"""
+    with open("/proc/%d/stat" % pid, "rb") as f:
+        # Split after the command name, which may itself contain spaces;
+        # fields[0] is then field 3 (state) of proc(5)
+        fields = f.read().rpartition(b")")[2].split()
+    return (
+        int(fields[11]) + int(fields[12]),  # utime + stime
+        int(fields[19]),  # starttime
+        int(fields[20]),  # vsize
+        int(fields[21]) * _PAGE_SIZE,  # rss
+    )
+
+
+def _fast_read_io(pid):
+    """Return bytes read and written by pid from /proc/[pid]/io"""
+    read_bytes, write_bytes = 0, 0
+    with open("/proc/%d/io" % pid, "rb") as f:
+        for line in f:
+            if line.startswith(b"read_bytes:"):
+                read_bytes = int(line[11:])
+            elif line.startswith(b"write_bytes:"):
+                write_bytes = int(line[12:])
+    return read_bytes, write_bytes
+
+
+def _fast_direct_children(pid):
+    """Return PIDs of the direct children of pid from /proc/[pid]/task/*/children"""
+    children = []
+    try:
+        tids = os.listdir("/proc/%d/task" % pid)
+    except FileNotFoundError:
+        return children  # skip, process died in flight
+    for tid in tids:
+        try:
+            with open("/proc/%d/task/%s/children" % (pid, tid), "rb") as f:
+                children.extend(int(x) for x in f.read().split())
+        except (FileNotFoundError, ProcessLookupError):
+            continue  # skip, thread died in flight
+    return children
+
+
+def _fast_children(pid):
+    """Return PIDs of all descendants of pid from /proc/[pid]/task/*/children"""
+    children = []
+    parents = [pid]
+    while parents:
+        pids = _fast_direct_children(parents.pop())
+        children.extend(pids)
+        parents.extend(pids)
+    return children
+
+
+def _conv(x):
+    """Conversion of value to str for TSV (None becomes "-")"""
+    if x is None:
+        return "-"
+    elif isinstance(x, float):
+        return f"{x:.2f}"
+    elif isinstance(x, list):
+        return ",".join([f"{f:.2f}" for f in x])
+    else:
+        return str(x)
 
 
 class BenchmarkRecord:
     """Record type for benchmark times"""
 
+    #: TSV header, see ``get_header()``
+    _HEADER = "\t".join(
+        (
+            "s",
+            "h:m:s",
+            "max_rss",
+            "max_vms",
+            "max_uss",
+            "max_pss",
+            "io_in",
+            "io_out",
+            "mean_load",
+            "max_gpu_load",
+            "max_gpu_mem",
+        )
+    )
+    #: Format of a TSV row, taking the running time in seconds, h:m:s and
+    #: the remaining columns already converted by ``_conv()``
+    _FMT = "\t".join(["{:.4f}"] + ["{}"] * 10)
+
     @classmethod
     def get_header(klass):
-        return "\t".join(
-            (
-                "s",
-                "h:m:s",
-                "max_rss",
-                "max_vms",
-                "max_uss",
-                "max_pss",
-                "io_in",
-                "io_out",
-                "mean_load",
-                "max_gpu_load",
-                "max_gpu_mem",
-            )
-        )
+        return klass._HEADER
 
     def __init__(
         self,
@@ -72,10 +192,10 @@ class BenchmarkRecord:
         #: Maximal VMS in MB
         self.max_vms = max_vms
         self.vms = vms
-        #: Maximal USS in MB
+        #: Maximal USS in MB, only measured by a ``detailed`` BenchmarkTimer
         self.max_uss = max_uss
         self.uss = uss
-        #: Maximal PSS in MB
+        #: Maximal PSS in MB, only measured by a ``detailed`` BenchmarkTimer
         self.max_pss = max_pss
         self.pss = pss
         #: I/O read in bytes
@@ -95,105 +215,67 @@ class BenchmarkRecord:
         self.gpu_mem = gpu_mem
 
     def to_tsv(self, rt=False):
-        """Return ``str`` with the TSV representation of this record"""
-
-        def to_tsv_str(x):
-            """Conversion of value to str for TSV (None becomes "-")"""
-            if x is None:
-                return "-"
-            elif isinstance(x, float):
-                return "{:.2f}".format(x)
-            elif isinstance(x, list):
-                return ",".join(["{:.2f}".format(f) for f in x])
-            else:
-                return str(x)
-
-        def timedelta_to_str(x):
-            """Conversion of timedelta to str without fractions of seconds"""
-            mm, ss = divmod(x.seconds, 60)
-            hh, mm = divmod(mm, 60)
-            s = "%d:%02d:%02d" % (hh, mm, ss)
-            if x.days:
-
-                def plural(n):
-                    return n, abs(n) != 1 and "s" or ""
-
-                s = ("%d day%s, " % plural(x.days)) + s
-            return s
+        """Return ``str`` with the TSV representation of this record
 
+        Values that are None become "-", floats and lists of floats are
+        rounded to two decimal places.
+        """
         if rt:
-            return "\t".join(
-                map(
-                    to_tsv_str,
-                    (
-                        "{:.4f}".format(self.running_time),
-                        timedelta_to_str(datetime.timedelta(seconds=self.running_time)),
-                        self.rss,
-                        self.vms,
-                        self.uss,
-                        self.pss,
-                        self.io_in,
-                        self.io_out,
-                        100.0 * self.cpu_seconds / self.running_time,
-                        self.gpu_load,
-                        self.gpu_mem,
-                    ),
-                )
+            values = (
+                self.rss,
+                self.vms,
+                self.uss,
+                self.pss,
+                self.io_in,
+                self.io_out,
+                100.0 * self.cpu_seconds / self.running_time,
+                self.gpu_load,
+                self.gpu_mem,
             )
         else:
-            return "\t".join(
-                map(
-                    to_tsv_str,
-                    (
-                        "{:.4f}".format(self.running_time),
-                        timedelta_to_str(datetime.timedelta(seconds=self.running_time)),
-                        self.max_rss,
-                        self.max_vms,
-                        self.max_uss,
-                        self.max_pss,
-                        self.io_in,
-                        self.io_out,
-                        100.0 * self.cpu_seconds / self.running_time,
-                        self.max_gpu_load,
-                        self.max_gpu_mem,
-                    ),
-                )
+            values = (
+                self.max_rss,
+                self.max_vms,
+                self.max_uss,
+                self.max_pss,
+                self.io_in,
+                self.io_out,
+                100.0 * self.cpu_seconds / self.running_time,
+                self.max_gpu_load,
+                self.max_gpu_mem,
             )
 
+        # Running time as h:m:s without fractions of seconds
+        hh, rem = divmod(int(self.running_time), 3600)
+        mm, ss = divmod(rem, 60)
+        if self.running_time >= 86400:
+            days, hh = divmod(hh, 24)
+            hms = f"{days} day{'s' if days != 1 else ''}, {hh}:{mm:02d}:{ss:02d}"
+        else:
+            hms = f"{hh}:{mm:02d}:{ss:02d}"
 
-class DaemonTimer(threading.Thread):
-    """Variant of threading.Timer that is deaemonized"""
-
-    def __init__(self, interval, function, args=None, kwargs=None):
-        threading.Thread.__init__(self, daemon=True)
-        self.interval = interval
-        self.function = function
-        self.args = args if args is not None else []
-        self.kwargs = kwargs if kwargs is not None else {}
-        self.finished = threading.Event()
-
-    def cancel(self):
-        """Stop the timer if it hasn't finished yet."""
-        self.finished.set()
-
-    def run(self):
-        self.finished.wait(self.interval)
-        if not self.finished.is_set():
-            self.function(*self.args, **self.kwargs)
-        self.finished.set()
+        return self._FMT.format(
+            self.running_time, hms, *[_conv(x) for x in values]
+        )
 
 
 class ScheduledPeriodicTimer:
     """Scheduling of periodic events
 
-    Up to self._interval, schedule actions per second, above schedule events
-    in self._interval second gaps.
+    Actions are run by a single daemonized sampler thread. The first gap
+    between actions is self._base_interval seconds, each following gap is
+    self._growth times longer than the last, up to a ceiling of
+    self._max_interval seconds.
     """
 
-    def __init__(self, interval):
+    def __init__(self, base_interval, max_interval, growth=BENCHMARK_INTERVAL_GROWTH):
         self._times_called = 0
-        self._interval = interval
-        self._timer = None
+        self._base_interval = base_interval
+        self._max_interval = max_interval
+        self._growth = growth
+        self._next_interval = base_interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
         self._stopped = True
         self._gpu = False
         self._rtpath = None
@@ -201,63 +283,127 @@ class ScheduledPeriodicTimer:
 
     def start(self):
         """Start the intervalic timer"""
-        self.start_time = time.time()
-        self.work()
-        self._times_called += 1
+        self.start_time = time.monotonic()
         self._stopped = False
-        if self._times_called > self._interval:
-            self._timer = DaemonTimer(self._interval, self._action)
-        else:
-            self._timer = DaemonTimer(BENCHMARK_INTERVAL_SHORT, self._action)
-        self._timer.start()
-
-    def _action(self):
-        """Internally, called by timer"""
         self.work()
         self._times_called += 1
-        if self._times_called > self._interval:
-            self._timer = DaemonTimer(self._interval, self._action)
-        else:
-            self._timer = DaemonTimer(BENCHMARK_INTERVAL_SHORT, self._action)
-        self._timer.start()
+        self._thread.start()
+
+    def _interval(self):
+        """Return the gap before the next action and advance the schedule"""
+        interval = self._next_interval
+        # Geometric backoff, equivalent to base * growth**times_called
+        self._next_interval = min(self._max_interval, interval * self._growth)
+        return interval
+
+    def _loop(self):
+        """Internally, run by the sampler thread until cancelled"""
+        while not self._stop.wait(self._interval()):
+            self.work()
+            self._times_called += 1
 
     def work(self):
         """Override to perform the action"""
         raise NotImplementedError("Override me!")
 
     def cancel(self):
-        """Call to cancel any events"""
-        self._timer.cancel()
+        """Call to cancel any events, waits for an in-flight action"""
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
         self._stopped = True
 
 
 class BenchmarkTimer(ScheduledPeriodicTimer):
-    """Allows easy observation of a given PID for resource usage"""
+    """Allows easy observation of a given PID for resource usage
 
-    def __init__(self, pid, bench_record, interval=BENCHMARK_INTERVAL, gpus=None, rt_path=None):
-        ScheduledPeriodicTimer.__init__(self, interval)
+    USS and PSS are only measured if ``detailed`` is set, as this requires
+    parsing the comparatively expensive ``/proc/[pid]/smaps``.
+    """
+
+    def __init__(
+        self,
+        pid,
+        bench_record,
+        interval=BENCHMARK_INTERVAL,
+        gpus=None,
+        rt_path=None,
+        detailed=False,
+        min_interval=BENCHMARK_INTERVAL_SHORT * 0.9,
+    ):
+        ScheduledPeriodicTimer.__init__(self, base_interval=BENCHMARK_INTERVAL_SHORT, max_interval=interval)
         #: PID of observed process
         self.pid = pid
-        self.main = psutil.Process(self.pid)
+        self.main = _lazy_psutil().Process(self.pid)
         #: ``BenchmarkRecord`` to write results to
         self.bench_record = bench_record
-        #: Cache of processes to keep track of cpu percent
+        #: Cache of processes to keep track of cpu percent, pruned to the
+        #: processes seen alive in the latest sample
         self.procs = {}
+        #: Whether to measure USS and PSS in addition to RSS and VMS
+        self.detailed = detailed
+        #: Samples closer than this (in seconds) to the previous one are skipped,
+        #: never more than the sampling interval itself so no tick is dropped
+        #: merely for being on schedule
+        self.min_interval = min(min_interval, self._base_interval, self._max_interval)
+        #: Cached list of children of the observed process, when it was taken,
+        #: and the direct children of the observed process at that time
+        self._children_cache = None
+        self._children_cache_t = 0
+        self._children_direct = None
+        #: Whether the kernel exposes /proc/[pid]/task/[tid]/children
+        self._proc_children = PROC_FS and os.path.exists(
+            "/proc/%d/task/%d/children" % (pid, pid)
+        )
+        #: Whether to sample from /proc directly rather than through psutil
+        self._fast = self._proc_children and not detailed
+        #: CPU time (in clock ticks) of each process alive at the previous
+        #: sample, by PID and start time
+        self._cpu_ticks = {}
+        #: Whether to measure I/O, cleared for good once the OS turns out not
+        #: to track it
+        self._check_io = self._fast or hasattr(psutil.Process, "io_counters")
 
         if gpus:
             self._gpu = True
             self.gpus = gpus
+            _lazy_pynvml().nvmlInit()
+            n_gpus = pynvml.nvmlDeviceGetCount()
+            invalid = [i for i in gpus if not 0 <= i < n_gpus]
+            if invalid:
+                pynvml.nvmlShutdown()
+                raise WorkflowError(
+                    "Cannot benchmark GPU(s) {}, only {} device(s) found".format(
+                        ",".join(map(str, invalid)), n_gpus
+                    )
+                )
+            #: NVML device handles, in the same order as ``gpus``
+            self.gpu_handles = [pynvml.nvmlDeviceGetHandleByIndex(i) for i in gpus]
             self.bench_record.max_gpu_load = [-1] * len(gpus)
             self.bench_record.max_gpu_mem = [-1] * len(gpus)
             self.bench_record.gpu_load = [-1] * len(gpus)
             self.bench_record.gpu_mem = [-1] * len(gpus)
         if rt_path:
             self._rtpath = rt_path
-            write_benchmark_records([], self._rtpath, head=True)
+            #: Real-time benchmark file, held open for the lifetime of the timer
+            self._rtfile = open(self._rtpath, "wb")
+            self._rtfile.write(encode_benchmark_records([], head=True))
+            self._rtfile.flush()
 
+    def cancel(self):
+        """Call to cancel any events, release NVML and close the real-time
+        benchmark file"""
+        ScheduledPeriodicTimer.cancel(self)
+        if self._gpu:
+            pynvml.nvmlShutdown()
+        if self._rtpath:
+            self._rtfile.close()
 
     def work(self):
         """Write statistics"""
+        prev_time = self.bench_record.prev_time
+        if prev_time is not None and time.monotonic() - prev_time < self.min_interval:
+            return  # skip, previous sample was too recent
         try:
             self._update_record()
         except psutil.NoSuchProcess:
@@ -266,90 +412,188 @@ class BenchmarkTimer(ScheduledPeriodicTimer):
             pass  # skip, process died in flight
 
         if self._rtpath:
-            write_benchmark_records([self.bench_record], self._rtpath, head=False, mode='a', rt=True)
-
-    def _update_record(self):
-        """Perform the actual measurement"""
-        # Memory measurements
+            self._rtfile.write(
+                encode_benchmark_records([self.bench_record], head=False, rt=True)
+            )
+            self._rtfile.flush()
+
+    def _children(self, this_time):
+        """Return the children of the observed process
+
+        Reading /proc/[pid]/task/*/children directly is cheap, so when
+        sampling from /proc the tree is walked every time. When sampling
+        through psutil, the cached list is reused unless it is empty (the
+        workload may not have been spawned yet), older than
+        BENCHMARK_CHILDREN_TTL, or the direct children of the observed
+        process have changed. Where the direct children cannot be read
+        cheaply from /proc, only the first two conditions apply.
+        """
+        if self._fast:
+            return _fast_children(self.pid)
+        direct = None
+        if self._proc_children:
+            direct = set(_fast_direct_children(self.pid))
+        if (
+            not self._children_cache
+            or this_time - self._children_cache_t > BENCHMARK_CHILDREN_TTL
+            or (direct is not None and direct != self._children_direct)
+        ):
+            self._children_cache = self.main.children(recursive=True)
+            self._children_cache_t = this_time
+            self._children_direct = direct
+        return self._children_cache
+
+    def _sample_psutil(self, this_time):
+        """Sum resource usage (in bytes) over the process and all children
+        using psutil"""
         rss, vms, uss, pss = 0, 0, 0, 0
-        # I/O measurements
         io_in, io_out = 0, 0
-        check_io = True
-        # CPU seconds
         cpu_seconds = 0
+        mem_attr = "memory_full_info" if self.detailed else "memory_info"
+        procs = {}
+        for proc in chain((self.main,), self._children(this_time)):
+            proc = self.procs.get(proc.pid, proc)
+            procs[proc.pid] = proc
+            attrs = [mem_attr, "cpu_percent"]
+            if self._check_io:
+                attrs.append("io_counters")
+            try:
+                # Reads all attributes within a single oneshot()
+                try:
+                    d = proc.as_dict(attrs=attrs, ad_value=None)
+                except NotImplementedError:
+                    if "io_counters" not in attrs:
+                        raise
+                    # OS may not track IO, read everything else
+                    self._check_io = False
+                    attrs.remove("io_counters")
+                    d = proc.as_dict(attrs=attrs, ad_value=None)
+            except NotImplementedError:
+                continue  # skip, OS doesn't provide these stats
+            except psutil.NoSuchProcess:
+                if proc is self.main:
+                    raise
+                # Cached child has exited, rescan the tree next time
+                self._children_cache = None
+                del procs[proc.pid]
+                continue
+            if self.bench_record.prev_time is not None and d["cpu_percent"] is not None:
+                cpu_seconds += (
+                    d["cpu_percent"]
+                    / 100
+                    * (this_time - self.bench_record.prev_time)
+                )
+            meminfo = d[mem_attr]
+            if meminfo is not None:
+                if self.detailed:
+                    uss += meminfo.uss
+                    pss += meminfo.pss
+                rss += meminfo.rss
+                vms += meminfo.vms
+            if self._check_io:
+                ioinfo = d.get("io_counters")
+                # None if we may not read this process' IO, skip it this sample
+                if ioinfo is not None:
+                    io_in += ioinfo.read_bytes
+                    io_out += ioinfo.write_bytes
+        # Forget processes that have exited, so the cache cannot grow unbounded
+        self.procs = procs
+        return rss, vms, uss, pss, io_in, io_out, cpu_seconds
+
+    def _sample_procfs(self, this_time):
+        """Sum resource usage (in bytes) over the process and all children
+        by reading /proc directly"""
+        rss, vms = 0, 0
+        io_in, io_out = 0, 0
+        cpu_ticks = 0
+        prev_ticks, self._cpu_ticks = self._cpu_ticks, {}
+        for pid in chain((self.pid,), self._children(this_time)):
+            try:
+                ticks, start, proc_vms, proc_rss = _fast_read_stat(pid)
+                if self._check_io:
+                    try:
+                        proc_in, proc_out = _fast_read_io(pid)
+                        io_in += proc_in
+                        io_out += proc_out
+                    except PermissionError:
+                        pass  # skip, may not read this process' IO
+            except (FileNotFoundError, ProcessLookupError):
+                if pid == self.pid:
+                    raise psutil.NoSuchProcess(pid)
+                continue  # skip, process died in flight
+            # As with psutil's cpu_percent(), a process' first sample is the
+            # baseline; keying by start time too tells apart a reused PID
+            key = (pid, start)
+            if key in prev_ticks and self.bench_record.prev_time is not None:
+                cpu_ticks += ticks - prev_ticks[key]
+            self._cpu_ticks[key] = ticks
+            rss += proc_rss
+            vms += proc_vms
+        return rss, vms, 0, 0, io_in, io_out, cpu_ticks / _CLK_TCK
+
+    def _sample_gpus(self):
+        """Return load (in %) and memory used (in MB) of each benchmarked GPU"""
+        return [sample_gpu(handle) for handle in self.gpu_handles]
 
-        if self._gpu:
-            # GPU measurements
-            gpu_load, gpu_mem = 0, 0
-
-        # Iterate over process and all children
+    def _update_record(self):
+        """Perform the actual measurement"""
         try:
-            this_time = time.time()
+            this_time = time.monotonic()
             self.bench_record.running_time = this_time - self.start_time
-            for proc in chain((self.main,), self.main.children(recursive=True)):
-                proc = self.procs.setdefault(proc.pid, proc)
-                with proc.oneshot():
-                    if self.bench_record.prev_time:
-                        cpu_seconds += (
-                            proc.cpu_percent()
-                            / 100
-                            * (this_time - self.bench_record.prev_time)
-                        )
-                    meminfo = proc.memory_full_info()
-                    rss += meminfo.rss
-                    vms += meminfo.vms
-                    uss += meminfo.uss
-                    pss += meminfo.pss
-                    if check_io:
-                        try:
-                            ioinfo = proc.io_counters()
-                            io_in += ioinfo.read_bytes
-                            io_out += ioinfo.write_bytes
-                        except NotImplementedError as nie:
-                            # OS doesn't track IO
-                            check_io = False
+            if self._fast:
+                sample = self._sample_procfs(this_time)
+            else:
+                sample = self._sample_psutil(this_time)
+            rss, vms, uss, pss, io_in, io_out, cpu_seconds = sample
+            if self.bench_record.first_time is None:
+                self.bench_record.first_time = this_time
             self.bench_record.prev_time = this_time
-            if not self.bench_record.first_time:
-                self.bench_record.prev_time = this_time
-            rss /= 1024 * 1024
-            vms /= 1024 * 1024
-            uss /= 1024 * 1024
-            pss /= 1024 * 1024
-            if check_io:
-                io_in /= 1024 * 1024
-                io_out /= 1024 * 1024
+            rss *= _MB
+            vms *= _MB
+            if self.detailed:
+                uss *= _MB
+                pss *= _MB
+            else:
+                uss = None
+                pss = None
+            if self._check_io:
+                io_in *= _MB
+                io_out *= _MB
             else:
                 io_in = None
                 io_out = None
         except psutil.Error as e:
             return
 
+        record = self.bench_record
         if self._gpu:
-            for gpu_i, gpu in enumerate(self.gpus):
-                gpu_load = GPUtil.getGPUs()[gpu].load*100
-                gpu_mem = GPUtil.getGPUs()[gpu].memoryUsed # MB
-                self.bench_record.max_gpu_load[gpu_i] = max(self.bench_record.max_gpu_load[gpu_i] or 0, gpu_load)
-                self.bench_record.max_gpu_mem[gpu_i] = max(self.bench_record.max_gpu_mem[gpu_i] or 0, gpu_mem)
-                self.bench_record.gpu_load[gpu_i] = gpu_load
-                self.bench_record.gpu_mem[gpu_i] = gpu_mem
+            try:
+                for gpu_i, (gpu_load, gpu_mem) in enumerate(self._sample_gpus()):
+                    record.max_gpu_load[gpu_i] = max(record.max_gpu_load[gpu_i] or 0, gpu_load)
+                    record.max_gpu_mem[gpu_i] = max(record.max_gpu_mem[gpu_i] or 0, gpu_mem)
+                    record.gpu_load[gpu_i] = gpu_load
+                    record.gpu_mem[gpu_i] = gpu_mem
+            except pynvml.NVMLError:
+                pass  # skip, NVML failed in flight
 
         # Update benchmark record's RSS and VMS
-        self.bench_record.max_rss = max(self.bench_record.max_rss or 0, rss)
-        self.bench_record.max_vms = max(self.bench_record.max_vms or 0, vms)
-        self.bench_record.max_uss = max(self.bench_record.max_uss or 0, uss)
-        self.bench_record.max_pss = max(self.bench_record.max_pss or 0, pss)
-        self.bench_record.rss = rss
-        self.bench_record.vms = vms
-        self.bench_record.uss = uss
-        self.bench_record.pss = pss
+        record.max_rss = max(record.max_rss or 0, rss)
+        record.max_vms = max(record.max_vms or 0, vms)
+        if self.detailed:
+            record.max_uss = max(record.max_uss or 0, uss)
+            record.max_pss = max(record.max_pss or 0, pss)
+        record.rss = rss
+        record.vms = vms
+        record.uss = uss
+        record.pss = pss
 
-        self.bench_record.io_in = io_in
-        self.bench_record.io_out = io_out
-        self.bench_record.cpu_seconds += cpu_seconds
+        record.io_in = io_in
+        record.io_out = io_out
+        record.cpu_seconds += cpu_seconds
 
 
 @contextlib.contextmanager
-def benchmarked(pid=None, benchmark_record=None, interval=BENCHMARK_INTERVAL, gpus=None, rt_path=None):
+def benchmarked(pid=None, benchmark_record=None, interval=BENCHMARK_INTERVAL, gpus=None, rt_path=None, detailed=False):
     """Measure benchmark parameters while within the context manager
 
     Yields a ``BenchmarkRecord`` with the results (values are set after
@@ -360,6 +604,13 @@ def benchmarked(pid=None, benchmark_record=None, interval=BENCHMARK_INTERVAL, gp
     created and returned, otherwise, the object passed as this parameter is
     returned.
 
+    If ``detailed`` is set then USS and PSS are also measured, otherwise
+    they are reported as "-".
+
+    If BENCHMARK_DAEMON_SOCKET is set and the daemon can be reached, the
+    process is registered with the daemon for sampling, otherwise it is
+    sampled by a ``BenchmarkTimer`` thread in this process.
+
     Usage::
 
         with benchmarked() as bench_result:
@@ -369,12 +620,34 @@ def benchmarked(pid=None, benchmark_record=None, interval=BENCHMARK_INTERVAL, gp
     if pid is False:
         yield result
     else:
-        start_time = time.time()
-        bench_thread = BenchmarkTimer(int(pid or os.getpid()), result, interval, gpus=gpus, rt_path=rt_path)
-        bench_thread.start()
-        yield result
-        bench_thread.cancel()
-        result.running_time = time.time() - start_time
+        pid = int(pid or os.getpid())
+        start_time = time.monotonic()
+        client = None
+        if BENCHMARK_DAEMON_SOCKET:
+            from benchmark_daemon import BenchmarkDaemonClient
+
+            try:
+                client = BenchmarkDaemonClient(BENCHMARK_DAEMON_SOCKET)
+            except OSError:
+                pass  # daemon not running, fall back to sampling in-process
+        if client:
+            try:
+                client.register(pid, interval, gpus=gpus, rt_path=rt_path, detailed=detailed)
+                try:
+                    yield result
+                finally:
+                    client.unregister(pid, result)
+            finally:
+                client.close()
+        else:
+            bench_thread = BenchmarkTimer(pid, result, interval, gpus=gpus, rt_path=rt_path, detailed=detailed)
+            bench_thread.start()
+            try:
+                yield result
+            finally:
+                # Always release the rt file and NVML, even if the body raised
+                bench_thread.cancel()
+        result.running_time = time.monotonic() - start_time
 
 
 def print_benchmark_records(records, file_, head=True, rt=False):
@@ -385,6 +658,13 @@ def print_benchmark_records(records, file_, head=True, rt=False):
         print(r.to_tsv(rt=rt), file=file_)
 
 
+def encode_benchmark_records(records, head=True, rt=False):
+    """Return benchmark records as TSV ``bytes``"""
+    lines = [BenchmarkRecord.get_header()] if head else []
+    lines.extend(r.to_tsv(rt=rt) for r in records)
+    return "".join(line + "\n" for line in lines).encode()
+
+
 def write_benchmark_records(records, path, head=True, mode="w", rt=False):
     """Write benchmark records to file at path"""
     with open(path, mode) as f:
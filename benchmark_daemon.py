@@ -0,0 +1,294 @@
+"""Out-of-process sampler shared by concurrent benchmarks
+
+When many rules run in parallel, each ``benchmarked()`` job would otherwise
+start its own sampler thread, walking /proc and querying NVML independently.
+Instead, start one daemon per machine::
+
+    python3 benchmark_daemon.py /tmp/reticulatus-benchmark.sock
+
+and export RETICULATUS_BENCHMARK_SOCKET=/tmp/reticulatus-benchmark.sock to
+the workflow. ``benchmarked()`` then registers each job's PID with the
+daemon, which samples all registered processes from a single timer and
+queries each GPU once per tick, however many jobs watch it. Real-time
+records are still written to each job's own rt file.
+
+Requests and replies are single lines of JSON over the Unix socket, one
+connection per benchmark. Closing the connection unregisters its PID.
+"""
+
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+import benchmark
+from benchmark import (
+    BENCHMARK_DAEMON_SOCKET,
+    BENCHMARK_INTERVAL_SHORT,
+    BenchmarkRecord,
+    BenchmarkTimer,
+    ScheduledPeriodicTimer,
+    sample_gpu,
+)
+
+from snakemake.exceptions import WorkflowError
+
+
+class SharedBenchmarkTimer(BenchmarkTimer):
+    """BenchmarkTimer that is sampled by a BenchmarkDaemon, rather than by a
+    thread of its own"""
+
+    def __init__(self, sampler, *args, **kwargs):
+        BenchmarkTimer.__init__(self, *args, **kwargs)
+        #: ``BenchmarkDaemon`` sampling this timer
+        self.sampler = sampler
+        self.start_time = time.monotonic()
+        self._stopped = False
+        #: When this timer is next due to be sampled, following the same
+        #: schedule as a BenchmarkTimer running its own thread
+        self.due = self.start_time
+        #: Why sampling this timer failed, if it did
+        self.error = None
+
+    def _sample_gpus(self):
+        """Return load (in %) and memory used (in MB) of each benchmarked GPU,
+        from the daemon's sweep of the current tick"""
+        sweep = self.sampler.gpu_sweep
+        if not all(i in sweep for i in self.gpus):
+            raise benchmark.pynvml.NVMLError(benchmark.pynvml.NVML_ERROR_UNKNOWN)
+        return [sweep[i] for i in self.gpus]
+
+
+class BenchmarkDaemon(ScheduledPeriodicTimer):
+    """Samples every registered benchmark from a single timer
+
+    The daemon ticks every BENCHMARK_INTERVAL_SHORT seconds, and on each tick
+    samples the registered timers that are due.
+    """
+
+    def __init__(self):
+        ScheduledPeriodicTimer.__init__(
+            self,
+            base_interval=BENCHMARK_INTERVAL_SHORT,
+            max_interval=BENCHMARK_INTERVAL_SHORT,
+        )
+        #: Registered ``SharedBenchmarkTimer``, by PID
+        self.timers = {}
+        #: Load and memory used of each GPU at the current tick, by device index
+        self.gpu_sweep = {}
+        self._lock = threading.Lock()
+
+    def register(self, pid, interval, gpus=None, rt_path=None, detailed=False):
+        """Start sampling pid, which must not already be registered"""
+        # Check before creating the timer, which would truncate the rt file
+        with self._lock:
+            if pid in self.timers:
+                raise ValueError("PID {} is already being benchmarked".format(pid))
+        timer = SharedBenchmarkTimer(
+            self,
+            pid,
+            BenchmarkRecord(),
+            interval,
+            gpus=gpus,
+            rt_path=rt_path,
+            detailed=detailed,
+        )
+        with self._lock:
+            if pid in self.timers:
+                timer.cancel()
+                raise ValueError("PID {} is already being benchmarked".format(pid))
+            # Take the first sample straight away, as ScheduledPeriodicTimer.start()
+            # does, so jobs shorter than a tick are still measured
+            if timer._gpu:
+                self.gpu_sweep = self._sweep_gpus(set(timer.gpus))
+            try:
+                timer.work()
+            except Exception:
+                self._cancel_quietly(timer)
+                raise
+            timer.due = time.monotonic() + timer._interval()
+            self.timers[pid] = timer
+
+    def unregister(self, pid):
+        """Stop sampling pid, returning its ``BenchmarkRecord`` or None if it
+        was not registered
+
+        Raises RuntimeError if sampling pid failed, as its record is then
+        incomplete.
+        """
+        with self._lock:
+            timer = self.timers.pop(pid, None)
+        if timer is None:
+            return None
+        if timer.error is not None:
+            # Already cancelled when it failed
+            raise RuntimeError("Benchmarking PID {} failed: {}".format(pid, timer.error))
+        timer.cancel()
+        return timer.bench_record
+
+    def _sweep_gpus(self, gpus):
+        """Return load and memory used of each GPU device index in gpus"""
+        sweep = {}
+        for i in gpus:
+            try:
+                sweep[i] = sample_gpu(benchmark.pynvml.nvmlDeviceGetHandleByIndex(i))
+            except benchmark.pynvml.NVMLError:
+                pass  # skip, NVML failed in flight
+        return sweep
+
+    def work(self):
+        """Sample the registered timers that are due"""
+        this_time = time.monotonic()
+        with self._lock:
+            due = [
+                t for t in self.timers.values()
+                if t.error is None and t.due <= this_time
+            ]
+            if not due:
+                return
+            self.gpu_sweep = self._sweep_gpus({i for t in due if t._gpu for i in t.gpus})
+            for timer in due:
+                try:
+                    timer.work()
+                except Exception as e:
+                    # Stop only the failing benchmark, keep sampling the others;
+                    # the timer stays registered so unregister reports the error
+                    print(
+                        "[benchmark_daemon] Stopped benchmarking PID %d: %s" % (timer.pid, e),
+                        file=sys.stderr,
+                    )
+                    timer.error = str(e)
+                    self._cancel_quietly(timer)
+                    continue
+                timer.due = this_time + timer._interval()
+
+    @staticmethod
+    def _cancel_quietly(timer):
+        """Cancel a failed timer, ignoring errors releasing its resources"""
+        try:
+            timer.cancel()
+        except Exception:
+            pass
+
+
+class BenchmarkRequestHandler(socketserver.StreamRequestHandler):
+    """Serves one benchmark: a register request followed by an unregister
+    request, or the connection closing"""
+
+    def handle(self):
+        sampler = self.server.sampler
+        pid = None
+        try:
+            for line in self.rfile:
+                request = json.loads(line.decode())
+                reply = {"ok": True}
+                try:
+                    if request["cmd"] == "register":
+                        sampler.register(
+                            request["pid"],
+                            request["interval"],
+                            gpus=request["gpus"],
+                            rt_path=request["rt_path"],
+                            detailed=request["detailed"],
+                        )
+                        pid = request["pid"]
+                    elif request["cmd"] == "unregister":
+                        record = sampler.unregister(request["pid"])
+                        pid = None
+                        reply["record"] = vars(record) if record else None
+                    else:
+                        raise ValueError("Unknown command {}".format(request["cmd"]))
+                except Exception as e:
+                    reply = {"ok": False, "error": str(e)}
+                self.wfile.write((json.dumps(reply) + "\n").encode())
+        finally:
+            if pid is not None:
+                sampler.unregister(pid)
+
+
+class BenchmarkDaemonClient:
+    """Connection to a running benchmark daemon, for a single benchmark"""
+
+    def __init__(self, path):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._sock.connect(path)
+        except OSError:
+            self._sock.close()
+            raise
+        self._file = self._sock.makefile("rwb")
+
+    def _request(self, **request):
+        """Send request and return the daemon's reply"""
+        self._file.write((json.dumps(request) + "\n").encode())
+        self._file.flush()
+        line = self._file.readline()
+        if not line:
+            raise WorkflowError("Benchmark daemon closed the connection")
+        reply = json.loads(line.decode())
+        if not reply["ok"]:
+            raise WorkflowError("Benchmark daemon: {}".format(reply["error"]))
+        return reply
+
+    def register(self, pid, interval, gpus=None, rt_path=None, detailed=False):
+        """Have the daemon start sampling pid"""
+        self._request(
+            cmd="register",
+            pid=pid,
+            interval=interval,
+            gpus=gpus,
+            # The daemon does not share our working directory
+            rt_path=os.path.abspath(rt_path) if rt_path else None,
+            detailed=detailed,
+        )
+
+    def unregister(self, pid, bench_record):
+        """Have the daemon stop sampling pid, copying its results into
+        bench_record"""
+        record = self._request(cmd="unregister", pid=pid)["record"]
+        for key, value in (record or {}).items():
+            setattr(bench_record, key, value)
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else BENCHMARK_DAEMON_SOCKET
+    if not path:
+        sys.exit("usage: benchmark_daemon.py <socket path>")
+    if os.path.exists(path):
+        try:
+            BenchmarkDaemonClient(path).close()
+        except OSError:
+            os.unlink(path)  # stale socket left by a daemon that died
+        else:
+            sys.exit("A benchmark daemon is already listening on %s" % path)
+
+    # The daemon opens rt files with its own credentials, so only let our
+    # own user connect; the umask avoids a window before the chmod
+    old_umask = os.umask(0o077)
+    try:
+        server = socketserver.ThreadingUnixStreamServer(path, BenchmarkRequestHandler)
+    finally:
+        os.umask(old_umask)
+    os.chmod(path, 0o600)
+    sampler = BenchmarkDaemon()
+    sampler.start()
+    server.daemon_threads = True
+    server.sampler = sampler
+    print("[benchmark_daemon] Listening on %s" % path)
+    try:
+        server.serve_forever()
+    finally:
+        sampler.cancel()
+        server.server_close()
+        os.unlink(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -31,6 +31,7 @@ class shell:
     _process_args = {}
     _process_prefix = ""
     _process_suffix = ""
+    _benchmark_detailed = False
     _lock = threading.Lock()
     _processes = {}
 
@@ -67,6 +68,10 @@ class shell:
     def suffix(cls, suffix):
         cls._process_suffix = suffix
 
+    @classmethod
+    def benchmark_detailed(cls, detailed):
+        cls._benchmark_detailed = detailed
+
     @classmethod
     def kill(cls, jobid):
         with cls._lock:
@@ -150,7 +155,7 @@ class shell:
             gpu = None
             try:
                 gpu = [int(x) for x in context.get("params").devices.split(",")]
-                print("[snakeshell] Attempting to benchmark GPU process with GPUtil on devices: %s" % gpu)
+                print("[snakeshell] Attempting to benchmark GPU process with NVML on devices: %s" % gpu)
             except Exception as e:
                 pass
 
@@ -161,7 +166,15 @@ class shell:
             except Exception as e:
                 pass
 
-            with benchmarked(proc.pid, bench_record, gpus=gpu, rt_path=rt_bench_path, interval=15):
+            detailed = cls._benchmark_detailed
+            try:
+                detailed = bool(context.get("params").benchmark_detailed)
+            except Exception as e:
+                pass
+            if detailed:
+                print("[snakeshell] Attempting to benchmark USS and PSS")
+
+            with benchmarked(proc.pid, bench_record, gpus=gpu, rt_path=rt_bench_path, interval=15, detailed=detailed):
                 retcode = proc.wait()
         else:
             retcode = proc.wait()